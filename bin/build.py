@@ -4,8 +4,10 @@
 
 import argparse
 import gzip
+import locale
 import os
 import pathlib
+import shlex
 import shutil
 import subprocess
 import sys
@@ -19,12 +21,43 @@ ORANGE = "\033[38;5;214m"
 RED = "\033[31m"
 RESET = "\033[0m"
 
-# *** Global variables
-current_error_level = 20
+# Compression settings
+GZIP_COMPRESS_LEVEL = 6
+EMPTY_TRANSLATION_GZ = gzip.compress(b"", GZIP_COMPRESS_LEVEL, mtime=0)
+
+
+class ErrorLevel:
+    """
+    Tracks the current error level.
+
+    level contains the current error level so that each error
+    produces a unique exit code that can be traced back to the code.
+    This prevents having to change each error result as the code is changed.
+    It starts as 20 because display error considers any error level above 19
+    as a fatal error. It subtracts 19 so that the error exit starts at 1.
+    """
+    __slots__ = ("level",)
+
+    def __init__(self, level=20):
+        self.level = level
+
+    def increment(self, increment=1):
+        """
+        Increments the error level by given increment.
+
+        Args:
+            increment (int=1): The amount to increment the error level.
+
+        Returns:
+            int: The new error level.
+        """
+        self.level += increment
+        return self.level
 
 
 def main():
     args = parse_arguments()
+    errors = ErrorLevel()
 
     display_message(0, f"Building Package for {args.package_description}...")
 
@@ -37,19 +70,18 @@ def main():
     gpg_key = args.gpg_key or os.getenv("GPG_KEY")
     binary_directories = ["binary-amd64", "binary-arm64"]
 
-    # Create needed directories
+    # Create needed directories, main_path is created with the binary directories
     os.makedirs(deb_package_path, exist_ok=True)
-    os.makedirs(main_path, exist_ok=True)
 
     for binary_directory in binary_directories:
         os.makedirs(f"{main_path}/{binary_directory}", exist_ok=True)
 
     if args.build:
-        build_debian_package(debian_package_file)
+        build_debian_package(debian_package_file, errors, args.compression)
 
-    build_translation_file(stable_path)
-    build_packages_files(main_path, deb_package_path, binary_directories)
-    build_release(stable_path, gpg_key)
+    build_translation_file(stable_path, errors)
+    build_packages_files(main_path, deb_package_path, binary_directories, errors, args.legacy_hashes)
+    build_release(stable_path, gpg_key, errors, args.legacy_hashes)
 
     if not args.install:
         display_message(0, f"Package {args.package_description} built successfully.")
@@ -82,12 +114,18 @@ def parse_arguments():
     output_directory = parent_directory / "output"
     parser = argparse.ArgumentParser(description="Package build and deployment script.")
 
+    parser.add_argument("-c", "--compression",
+                        help="Specify the package compression (gzip, xz, zstd or none)",
+                        choices=["gzip", "xz", "zstd", "none"], default=None)
     parser.add_argument("-d", "--distribution_directory",
                         help="Specify the distribution path",
                         default="/var/www/html/distributions/debian")
     parser.add_argument("-f", "--filename", help="Specify the debian package filename.")
     parser.add_argument("-g", "--gpg_key", help="Specify the gpg key for signing",
                         default=os.getenv("GPG_KEY"))
+    parser.add_argument("-l", "--legacy-hashes",
+                        help="Include MD5 and SHA1 checksums in Packages and Release",
+                        action="store_true", dest="legacy_hashes", default=False)
     parser.add_argument("-n", "--no-build", help="Don't build the package",
                         action="store_false", dest="build", default=True)
     parser.add_argument("-N", "--no-install", help="Don't install the package",
@@ -116,69 +154,74 @@ def parse_arguments():
     return args
 
 
-def build_debian_package(debian_package_path):
+def build_debian_package(debian_package_path, errors, compression=None):
     """
     Build the Debian package.
 
     Args:
         debian_package_path (str): Path to the debian package.
+        errors (ErrorLevel): The current error level.
+        compression (str|None): The dpkg-deb compression type, None for the default.
     """
     display_message(0, f"Building {debian_package_path}...")
 
-    if os.path.isfile(debian_package_path):
-        try:
-            os.remove(debian_package_path)
-            display_message(0, f"Removed existing package: {debian_package_path}")
-        except Exception as e:
-            display_message(get_current_error_level(),
-                            f"Cannot remove existing package {debian_package_path}. {str(e)}")
+    # Build to a temporary file so an existing package survives a failed build
+    temporary_package_path = f"{debian_package_path}.tmp"
+    command = ["dpkg-deb", "--build", "distribution", temporary_package_path]
 
-    increment_error_level()
+    if compression:
+        command.insert(1, f"-Z{compression}")
 
-    result = run_command(f"dpkg-deb --build distribution {debian_package_path}", True, False)
+    # run_command exits if dpkg-deb fails, the finally still removes any partial
+    # temporary package so it is never published from the pool
+    try:
+        run_command(command, True, False)
 
-    if result:
-        display_message(0, f"Package {debian_package_path} built successfully.")
-    else:
-        display_message(get_current_error_level(), "Build failed.")
+        try:
+            os.replace(temporary_package_path, debian_package_path)
+        except Exception as e:
+            display_message(errors.level, f"Cannot replace package {debian_package_path}. {str(e)}")
+    finally:
+        if os.path.exists(temporary_package_path):
+            os.remove(temporary_package_path)
+
+    errors.increment()
 
-    increment_error_level()
+    display_message(0, f"Package {debian_package_path} built successfully.")
 
 
-def build_translation_file(stable_path):
+def build_translation_file(stable_path, errors):
     """
     Build the Translation file.
 
     Args:
         stable_path (str): Path to the stable directory.
+        errors (ErrorLevel): The current error level.
     """
     cwd = os.getcwd()
     translation_directory = "i18n"
-    translation_filename = "Translation-en"
     translation_gz_filename = "Translation-en.gz"
 
     os.chdir(stable_path)
     os.makedirs(translation_directory, exist_ok=True)
     os.chdir(translation_directory)
 
-    display_message(0, f"Creating {translation_filename}...")
-    open(translation_filename, "w").close()
+    display_message(0, f"Creating {translation_gz_filename}...")
 
-    if os.path.isfile(translation_filename):
-        display_message(0, f"{translation_filename} built successfully.")
-    else:
-        display_message(get_current_error_level(), f"Cannot create {translation_filename}.")
+    # There are no translations so write a precomputed empty gzip stream
+    try:
+        with open(translation_gz_filename, "wb") as file:
+            file.write(EMPTY_TRANSLATION_GZ)
+    except Exception as e:
+        display_message(errors.level, f"Cannot create {translation_gz_filename}. {str(e)}")
 
-    increment_error_level()
-    display_message(0, f"GZipping {translation_filename} to {translation_gz_filename}...")
-    gzip_file(translation_filename, translation_gz_filename)
-    os.remove(translation_filename)
-    display_message(0, f"GZipped {translation_filename} to  {translation_gz_filename} successfully.")
+    errors.increment()
+    display_message(0, f"{translation_gz_filename} built successfully.")
     os.chdir(cwd)
 
 
 # noinspection PyBroadException
-def build_packages_files(main_path, debian_path, binary_directories):
+def build_packages_files(main_path, debian_path, binary_directories, errors, legacy_hashes=False):
     """
     Build the Packages files.
 
@@ -186,7 +229,24 @@ def build_packages_files(main_path, debian_path, binary_directories):
         main_path (str): Path to the main dir at output/dists/stable/main.
         debian_path (str): Path to the debian dir at output/dists/stable/.
         binary_directories (list): Names of the binary package directories.
+        errors (ErrorLevel): The current error level.
+        legacy_hashes (bool=False): Also generate MD5 and SHA1 checksums.
     """
+    hashes = "md5,sha1,sha256" if legacy_hashes else "sha256"
+
+    # Every architecture is built from the same pool so scan it only once
+    display_message(0, f"Scanning packages in {debian_path}...")
+
+    package_contents = run_command(["dpkg-scanpackages", "--hash", hashes, debian_path, "/dev/null"],
+                                   True, True)
+
+    if not package_contents.strip():
+        display_message(errors.level, "dpkg-scanpackage produced no output.")
+
+    errors.increment()
+
+    package_contents = package_contents.split("\n")
+
     for binary_directory in binary_directories:
         cwd = os.getcwd()
         binary_path = f"{main_path}/{binary_directory}"
@@ -195,15 +255,7 @@ def build_packages_files(main_path, debian_path, binary_directories):
 
         display_message(0, f"Building Package in {binary_path}...")
 
-        package_contents = run_command(f"dpkg-scanpackages {debian_path} /dev/null", True, True)
-
-        if not package_contents.strip():
-            display_message(get_current_error_level(), "dpkg-scanpackage produced no output.")
-
-        increment_error_level()
-
         output = []
-        package_contents = package_contents.split("\n")
 
         for line in package_contents:
             if line.startswith("Filename:"):
@@ -215,41 +267,54 @@ def build_packages_files(main_path, debian_path, binary_directories):
         package_file = "Packages"
         package_gz_file = "Packages.gz"
 
+        display_message(0, f"Writing {package_file} and {package_gz_file}...")
+
+        # Write Packages and Packages.gz together so the data is only produced once
+        # Encode with the locale codec run_command used to decode the dpkg-scanpackages output
+        package_encoding = locale.getpreferredencoding(False)
+        package_data = "".join(f"{line}\n" for line in output).encode(package_encoding)
+
         try:
-            with open(package_file, "w") as file:
-                for line in output:
-                    file.write(f"{line}\n")
+            with open(package_file, "wb") as file, \
+                    gzip.GzipFile(package_gz_file, "wb", GZIP_COMPRESS_LEVEL, mtime=0) as gz_file:
+                file.write(package_data)
+                gz_file.write(package_data)
         except Exception as e:
-            display_message(get_current_error_level(), f"Can't write to {package_file}. Error: {e}")
+            display_message(errors.level,
+                            f"Can't write to {package_file} or {package_gz_file}. Error: {e}")
 
-        increment_error_level()
+        errors.increment()
 
-        display_message(0, f"{package_file} built successfully.")
-        display_message(0, f"GZipping {package_file} to {package_gz_file}...")
-        gzip_file(package_file, package_gz_file)
-        display_message(0, f"{package_file} gzipped to {package_gz_file} successfully.")
+        display_message(0, f"{package_file} and {package_gz_file} built successfully.")
         os.chdir(cwd)
 
 
-def build_release(stable_path, gpg_key):
+def build_release(stable_path, gpg_key, errors, legacy_hashes=False):
     """
     Build the Release, Release.gpg, and InRelease files.
 
     Args:
         stable_path (str): The path to the stable directory.
         gpg_key (str): The GnuPG key.
+        errors (ErrorLevel): The current error level.
+        legacy_hashes (bool=False): Also generate MD5 and SHA1 checksums.
     """
     cwd = os.getcwd()
+    release_command = ["apt-ftparchive", "release", "."]
+
+    if not legacy_hashes:
+        release_command[1:1] = ["-o", "APT::FTPArchive::Release::MD5=false",
+                                "-o", "APT::FTPArchive::Release::SHA1=false"]
 
     os.chdir(stable_path)
     display_message(0, f"Building Release...")
 
-    release_output = run_command("apt-ftparchive release .", True, True)
+    release_output = run_command(release_command, True, True)
 
     if not release_output.strip():
-        display_message(get_current_error_level(), f"apt-ftparchive produced no output.")
+        display_message(errors.level, f"apt-ftparchive produced no output.")
 
-    increment_error_level()
+    errors.increment()
 
     codename_exists = "Codename" in release_output
     suite_exists = "Suite" in release_output
@@ -271,24 +336,23 @@ def build_release(stable_path, gpg_key):
 
     try:
         with open("Release", "w") as file:
-            for line in release_output:
-                file.write(f"{line}\n")
+            file.write("".join(f"{line}\n" for line in release_output))
     except Exception as e:
-        display_message(get_current_error_level(), f"Cannot write Release: {str(e)}.")
+        display_message(errors.level, f"Cannot write Release: {str(e)}.")
 
-    increment_error_level()
+    errors.increment()
 
     display_message(0, f"Created Release.")
 
     if not gpg_key:
-        display_message(get_current_error_level(), f"No GPG key can't sign Release.")
+        display_message(errors.level, f"No GPG key can't sign Release.")
 
-    increment_error_level()
+    errors.increment()
 
     display_message(0, f"Signing Release...")
     # Run GPG to sign the Release file and create InRelease
-    run_command(f"gpg -u {gpg_key} --clearsign -o InRelease Release", True, False)
-    run_command(f"gpg -u {gpg_key} --detach-sign -o Release.gpg Release", True, False)
+    run_command(["gpg", "-u", gpg_key, "--clearsign", "-o", "InRelease", "Release"], True, False)
+    run_command(["gpg", "-u", gpg_key, "--detach-sign", "-o", "Release.gpg", "Release"], True, False)
     display_message(0, "Successfully signed Release file.")
     os.chdir(cwd)
 
@@ -300,7 +364,7 @@ def display_message(error_level, message):
      is above 19.
 
     Args:
-        error_level (int): The amount to increment the current_error_level.
+        error_level (int): The error level of the message.
         message (str): The message to display.
 
     error_level contains the current error level.
@@ -320,35 +384,12 @@ def display_message(error_level, message):
         sys.exit(error_level - 19)
 
 
-def get_current_error_level():
-    return current_error_level
-
-
-def increment_error_level(increment=1):
-    """
-    Increments current_error_level level by given increment.
-
-    Args:
-        increment (int=1): The amount to increment the current_error_level.
-
-    current_error_level contains the current error level so that each error
-    produces a unique exit code that can be traced back to the code.
-    This prevents having to change each error result as the code is changed.
-    It starts as 20 because display error considers any error level above 19
-    as a fatal error. It subtracts 19 so that the error exit starts at 1.
-    """
-    global current_error_level
-
-    current_error_level += increment
-    return current_error_level
-
-
 def run_command(command, flag_error=True, capture_output=True, timeout=None, as_user=None):
     """
-    Execute a shell command and return the output.
+    Execute a command and return the output.
 
     Args:
-        command (str|list): The command to run.
+        command (list): The command and its arguments.
         capture_output (bool): Capture the output.
         flag_error (bool): Flag whether to exit with an error.
         timeout (float|None): Optional timeout for command execution.
@@ -357,56 +398,48 @@ def run_command(command, flag_error=True, capture_output=True, timeout=None, as_
     Returns:
         A string or a boolean based on capture_output.
     """
-    if isinstance(command, list):
-        command_str = " ".join(command)
-    else:
-        command_str = command
+    if isinstance(command, str):
+        raise TypeError(f"run_command expects an argument list, not the string '{command}'.")
+
+    command = [str(argument) for argument in command]
 
     if as_user:
-        command_str = f"su - {as_user} -c '{command_str}'"
+        command = ["su", "-", as_user, "-c", shlex.join(command)]
+
+    command_str = shlex.join(command)
 
     try:
         result = subprocess.run(
-                command_str,
+                command,
                 timeout=timeout,
-                shell=True,
-                capture_output=True,
+                stdout=subprocess.PIPE if capture_output else subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
                 text=True,
                 env=os.environ
         )
 
         if result.returncode != 0:
             if flag_error:
+                # Show the command's own error output before the fatal message exits
+                if result.stderr.strip():
+                    display_message(10, f"Error: {result.stderr.strip()}")
+
                 display_message(89, f"Command '{command_str}' failed with exit code {result.returncode}.")
-                display_message(89, f"Error: {result.stderr}")
             return "" if capture_output else False
 
         return result.stdout if capture_output else True
 
     except subprocess.TimeoutExpired:
         return "" if capture_output else False
+    except OSError as e:
+        if flag_error:
+            display_message(89, f"Command '{command_str}' could not be run. {str(e)}")
+        return "" if capture_output else False
     except subprocess.CalledProcessError as e:
         display_message(90, f"Error: Error running {command_str}. Error: {str(e)}")
         return "" if capture_output else False
 
 
-# noinspection PyTypeChecker
-def gzip_file(source_filename, destination_filename):
-    """
-    Compresses a file using GNU Zip (gzip).
-    Args:
-        source_filename (str): The file to compress.
-        destination_filename (str): The compress filename.
-    """
-    try:
-        with open(source_filename, "rb") as f_in, gzip.open(destination_filename, "wb") as f_out:
-            shutil.copyfileobj(f_in, f_out)
-    except Exception as e:
-        display_message(get_current_error_level(),
-                        f"Error: Failed to compress {source_filename}. {str(e)}")
-    increment_error_level()
-
-
 def change_ownership_recursive(path, user, group):
     """
     Recursively change owner and group of a directory and its contents.
@@ -417,6 +450,14 @@ def change_ownership_recursive(path, user, group):
     """
     display_message(0, f"Recursively changing owner to {user} for {path}...")
 
+    # Let chown do the whole tree in one process. path is resolved so a symlinked root is
+    # followed, while links inside the tree are re-owned themselves and not their targets.
+    # chown is present wherever dpkg runs, the Python walk below is only for hosts without it.
+    if shutil.which("chown"):
+        run_command(["chown", "-R", "--", f"{user}:{group}", os.path.realpath(path)], True, False)
+        display_message(0, f"Recursively changed owner to {user} for {path}.")
+        return
+
     # Get user and group IDs
     uid = pwd.getpwnam(user).pw_uid
     gid = grp.getgrnam(group).gr_gid
@@ -425,14 +466,26 @@ def change_ownership_recursive(path, user, group):
     os.chown(path, uid, gid)
 
     # Walk through all files and subdirectories
-    for root, dirs, files in os.walk(path):
-        for d in dirs:
-            os.chown(os.path.join(root, d), uid, gid)
-        for f in files:
-            os.chown(os.path.join(root, f), uid, gid)
+    change_ownership_entries(path, uid, gid)
 
     display_message(0, f"Recursively changed owner to {user} for {path}.")
 
 
+def change_ownership_entries(path, uid, gid):
+    """
+    Recursively change owner and group of the contents of a directory.
+    Args:
+        path (str): Path to the directory whose contents to change.
+        uid (int): The user ID of the new owner.
+        gid (int): The group ID of the new group.
+    """
+    with os.scandir(path) as entries:
+        for entry in entries:
+            os.chown(entry.path, uid, gid, follow_symlinks=False)
+
+            if entry.is_dir(follow_symlinks=False):
+                change_ownership_entries(entry.path, uid, gid)
+
+
 if __name__ == "__main__":
     main()